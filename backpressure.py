@@ -0,0 +1,140 @@
+import collections
+import threading
+import time
+
+import consts
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self):
+        '''Block until a token is available, then take it.'''
+        self.refill()
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
+
+
+class RateLimiter:
+    '''
+    One token bucket per key (peer id). Buckets that refilled completely
+    are forgotten once there are more than RATE_LIMITER_MAX_KEYS of them,
+    so spoofed keys cannot grow memory without bound.
+    '''
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def allow(self, key: str):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= consts.RATE_LIMITER_MAX_KEYS:
+                    self._forget_idle()
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            return bucket.consume()
+
+    def _forget_idle(self):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill()
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+
+class WorkQueue:
+    '''
+    Bounded queue between accepting and dispatching messages.
+
+    Messages addressed to us are always taken first. When the queue is
+    full, relay traffic is shed: new relay items are rejected, and a local
+    item evicts the oldest queued relay item.
+    '''
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.local = collections.deque()
+        self.relay = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.local) + len(self.relay)
+
+    def put(self, item, local: bool):
+        with self.cond:
+            if len(self) >= self.maxsize:
+                if not local:
+                    counters.incr('shed_relay')
+                    return False
+                if not self.relay:
+                    counters.incr('shed_local')
+                    return False
+                self.relay.popleft()
+                counters.incr('shed_relay')
+            (self.local if local else self.relay).append(item)
+            self.cond.notify()
+            return True
+
+    def get(self):
+        '''Block until an item is available. Returns None once closed.'''
+        with self.cond:
+            while not self.closed and not len(self):
+                self.cond.wait()
+            if self.closed:
+                return None
+            return (self.local or self.relay).popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Counters:
+    '''
+    Own counters plus the latest snapshots reported by daemon workers.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = collections.Counter()
+        self.remote = {}
+
+    def incr(self, name: str):
+        with self.lock:
+            self.values[name] += 1
+
+    def update_remote(self, source, values: dict):
+        with self.lock:
+            self.remote[source] = values
+
+    def snapshot(self):
+        with self.lock:
+            total = collections.Counter(self.values)
+            for values in self.remote.values():
+                total.update(values)
+            return dict(total)
+
+
+counters = Counters()
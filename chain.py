@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import math
+
+import consts
+
+
+class Chain:
+    '''
+    Fixed-size Bloom filter of peer ids a message has passed through.
+
+    Membership checks may give false positives (a relay wrongly thinks it
+    has seen the message), never false negatives. Flooding delivers the
+    message over other paths, so the cost of a false positive is small.
+
+    Encoded form is base64 of one byte with the number of hash functions
+    followed by the bit array, so peers with different settings still
+    understand each other.
+    '''
+
+    def __init__(self, size_bits=None, hashes=None, bits=None):
+        if size_bits is None or hashes is None:
+            size_bits, hashes = Chain.optimal_params(
+                consts.CHAIN_CAPACITY, consts.CHAIN_FALSE_POSITIVE_RATE
+            )
+        self.size_bits = size_bits
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray(math.ceil(size_bits / 8))
+
+    @staticmethod
+    def optimal_params(capacity: int, false_positive_rate: float):
+        size_bits = math.ceil(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        # Round up to whole bytes, nothing gained by leaving bits unused
+        size_bits = math.ceil(size_bits / 8) * 8
+        hashes = max(1, round(size_bits / capacity * math.log(2)))
+        return size_bits, hashes
+
+    def _positions(self, peer_id: str):
+        digest = hashlib.shake_128(peer_id.encode('utf-8')).digest(4 * self.hashes)
+        return (
+            int.from_bytes(digest[i : i + 4], 'little') % self.size_bits
+            for i in range(0, len(digest), 4)
+        )
+
+    def add(self, peer_id: str):
+        for pos in self._positions(peer_id):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+        return self
+
+    def __contains__(self, peer_id: str):
+        return all(
+            self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(peer_id)
+        )
+
+    def encode(self) -> str:
+        return base64.b64encode(bytes([self.hashes]) + self.bits).decode('utf-8')
+
+    @staticmethod
+    def decode(encoded: str):
+        '''Raises ValueError if `encoded` is not a valid chain.'''
+        if not isinstance(encoded, str):
+            raise ValueError('chain must be a string')
+        raw = base64.b64decode(encoded, validate=True)
+        if len(raw) < 2 or raw[0] < 1:
+            raise ValueError('chain needs hash count and at least one byte of bits')
+        return Chain(size_bits=(len(raw) - 1) * 8, hashes=raw[0], bits=bytearray(raw[1:]))
@@ -1,6 +1,69 @@
 DAEMON_HOST = '0.0.0.0'
 DAEMON_PORT = '41479'
 DB_NAME = 'messenger.db'
+# Seconds to wait for another process holding DB lock
+DB_TIMEOUT = 10
+CONTROL_SOCKET = 'messenger.sock'
+# Seconds CLI waits for daemon to answer a request
+CONTROL_TIMEOUT = 60
+# Messages queued for a `message watch` client before it is dropped as stalled
+WATCH_QUEUE_SIZE = 1024
 
 SCK_TIMEOUT = 0.3
+# Bounds of per-peer timeouts, adapted from observed RTT
+SCK_MIN_TIMEOUT = 0.05
+SCK_MAX_TIMEOUT = 3
 SCK_BUFF_SIZE = 512
+# Accepted connections are read on at most READ_WORKERS threads, and a
+# message must arrive whole within SCK_READ_TIMEOUT seconds
+READ_WORKERS = 16
+SCK_READ_TIMEOUT = 10
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Max number of hops a message may travel
+MSG_TTL = 16
+# Chain is a Bloom filter sized for CHAIN_CAPACITY hops
+CHAIN_CAPACITY = 32
+CHAIN_FALSE_POSITIVE_RATE = 0.01
+
+BULK_BATCH_SIZE = 100
+
+# Messages per second (and burst size) accepted from a neighbour peer
+PEER_RATE_LIMIT = 20
+PEER_RATE_BURST = 40
+# Messages per second (and burst size) accepted per original sender
+ORIGIN_RATE_LIMIT = 10
+ORIGIN_RATE_BURST = 20
+RATE_LIMITER_MAX_KEYS = 4096
+
+# Consecutive failures before peer is skipped, seconds before it is probed
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 30
+HEALTH_PERSIST_INTERVAL = 10
+HEALTH_REFRESH_INTERVAL = 1
+
+WORK_QUEUE_SIZE = 256
+DISPATCH_WORKERS = 2
+
+# Seen message ids are shared by daemon workers through the DB
+SEEN_TTL = 3600
+SEEN_PRUNE_INTERVAL = 60
+
+# Anti-entropy: envelopes of the last SYNC_WINDOW seconds are kept and
+# compared with neighbours in SYNC_BUCKET-second buckets
+SYNC_WINDOW = 24 * 3600
+SYNC_BUCKET = 600
+SYNC_INTERVAL = 300
+# Differing buckets are split by key hash, one hex digit per level, down to
+# SYNC_MAX_DEPTH levels, until a sub-bucket has at most SYNC_LEAF_SIZE keys
+SYNC_LEAF_SIZE = 16
+SYNC_MAX_DEPTH = 3
+SYNC_MAX_ENVELOPES = 500
+# Missing envelopes travel in one message, give it time to get through
+SYNC_SEND_TIMEOUT = 10
+# Seconds a neighbour may send envelopes we asked it for
+SYNC_EXPECT_TTL = 60
+
+MAX_WORKERS = 64
+WORKER_RESTART_DELAY = 1
+COUNTERS_REPORT_INTERVAL = 1
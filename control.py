@@ -0,0 +1,250 @@
+import json
+import logging
+import queue
+import socket
+import socketserver
+import threading
+
+import backpressure
+import consts
+import db
+import transport
+
+
+class Hub:
+    '''
+    Fans out freshly saved messages to every connected `message watch` client.
+
+    A client that falls WATCH_QUEUE_SIZE messages behind is unsubscribed,
+    so a stalled one cannot grow daemon memory.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.upstream = None
+
+    def forward_to(self, upstream):
+        '''
+        Send published messages to the supervisor process instead: daemon
+        workers do not own the control socket.
+        '''
+        self.upstream = upstream
+
+    def subscribe(self):
+        q = queue.Queue(consts.WATCH_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def is_subscribed(self, q):
+        with self.lock:
+            return q in self.subscribers
+
+    def publish(self, message: dict):
+        if self.upstream is not None:
+            self.upstream.put(('message', message))
+            return
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                logging.warning('Drop watch client: it is too slow')
+                self.unsubscribe(q)
+
+
+hub = Hub()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    '''
+    Handles one CLI connection on the control socket.
+
+    Requests and responses are newline-delimited JSON objects.
+    '''
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            self.reply({'ok': False, 'error': 'Malformed request'})
+            return
+
+        op = request.get('op')
+        try:
+            if op == 'send':
+                self.handle_send(request)
+            elif op == 'send-group':
+                self.handle_send_group(request)
+            elif op == 'watch':
+                self.handle_watch()
+            elif op == 'stats':
+                self.reply({'ok': True, 'counters': backpressure.counters.snapshot()})
+            else:
+                self.reply({'ok': False, 'error': f'Unknown op {op!r}'})
+        except Exception as exc:  # noqa
+            # Message may be stored and flooded already, CLI must not resend
+            logging.exception('Control request %r failed', op)
+            self.reply({'ok': False, 'error': f'{type(exc).__name__}: {exc}'})
+
+    def reply(self, response: dict):
+        self.wfile.write(_dump_line(response))
+        self.wfile.flush()
+
+    def handle_send(self, request):
+        peer = db.DB.fetch_peer_by_name(request['name'])
+        if not peer:
+            self.reply({'ok': False, 'error': f'Could not find peer {request["name"]!r}'})
+            return
+        success = self.server.transmitter.send_message(peer, request['body'])
+        self.reply({'ok': True, 'success': success})
+
+    def handle_send_group(self, request):
+        peers = [db.DB.fetch_peer_by_name(name) for name in request['names']]
+        missing = [name for name, peer in zip(request['names'], peers) if not peer]
+        if missing:
+            self.reply({'ok': False, 'error': f'Could not find peers {missing!r}'})
+            return
+        success = self.server.transmitter.send_group_message(peers, request['body'])
+        self.reply({'ok': True, 'success': success})
+
+    def handle_watch(self):
+        q = hub.subscribe()
+        try:
+            self.reply({'ok': True})
+            while not self.server.closing.is_set() and hub.is_subscribed(q):
+                try:
+                    message = q.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.reply(message)
+        except (BrokenPipeError, ConnectionResetError):
+            logging.info('Watch client disconnected')
+        finally:
+            hub.unsubscribe(q)
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, handler=ControlHandler):
+        self.transmitter = transport.Transmitter()
+        self.closing = threading.Event()
+        super().__init__(path, handler)
+
+    def shutdown(self):
+        self.closing.set()
+        super().shutdown()
+
+
+def _dump_line(message: dict) -> bytes:
+    return bytes(json.dumps(message) + '\n', encoding='utf-8')
+
+
+def _connect():
+    '''
+    Connect to the running daemon. Returns None if no daemon is listening.
+    '''
+    sck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sck.settimeout(consts.CONTROL_TIMEOUT)
+    try:
+        sck.connect(consts.CONTROL_SOCKET)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sck.close()
+        return None
+    return sck
+
+
+def is_running():
+    sck = _connect()
+    if sck is None:
+        return False
+    sck.close()
+    return True
+
+
+def _request(sck: socket.socket, request: dict):
+    sck.sendall(_dump_line(request))
+    return sck.makefile('rb')
+
+
+def _call(request: dict):
+    '''
+    Returns None only if no daemon is listening: once connected, the
+    daemon may have acted on the request, so failures come as errors.
+    '''
+    sck = _connect()
+    if sck is None:
+        return None
+    try:
+        with sck:
+            line = _request(sck, request).readline()
+    except OSError as exc:
+        return {'ok': False, 'error': f'No reply from daemon: {exc}'}
+    if not line:
+        return {'ok': False, 'error': 'Daemon closed connection without reply'}
+    return json.loads(line)
+
+
+def send(name: str, body: str):
+    '''
+    Hand an outgoing message over to the daemon.
+
+    Returns the daemon response, or None if the daemon is not running.
+    '''
+    return _call({'op': 'send', 'name': name, 'body': body})
+
+
+def send_group(names: list, body: str):
+    '''
+    Hand a group message over to the daemon.
+
+    Returns the daemon response, or None if the daemon is not running.
+    '''
+    return _call({'op': 'send-group', 'names': names, 'body': body})
+
+
+def stats():
+    '''
+    Fetch daemon counters.
+
+    Returns the daemon response, or None if the daemon is not running.
+    '''
+    return _call({'op': 'stats'})
+
+
+def watch():
+    '''
+    Subscribe to messages as the daemon saves them.
+
+    Returns an iterator of messages, or None if the daemon is not running.
+    '''
+    sck = _connect()
+    if sck is None:
+        return None
+    try:
+        stream = _request(sck, {'op': 'watch'})
+        line = stream.readline()
+    except OSError:
+        line = None
+    if not line:
+        sck.close()
+        return None
+    # Messages may be far apart
+    sck.settimeout(None)
+    return _iter_messages(sck, stream)
+
+
+def _iter_messages(sck: socket.socket, stream):
+    with sck:
+        for line in stream:
+            yield json.loads(line)
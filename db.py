@@ -1,4 +1,5 @@
 import contextlib
+import json
 import sqlite3
 
 import consts
@@ -7,10 +8,13 @@ import models
 
 @contextlib.contextmanager
 def get_cursor():
-    conn = sqlite3.connect(consts.DB_NAME)
+    conn = sqlite3.connect(consts.DB_NAME, timeout=consts.DB_TIMEOUT)
     try:
         yield conn.cursor()
-    finally:
+    except Exception:
+        conn.rollback()
+        raise
+    else:
         conn.commit()
 
 
@@ -46,22 +50,103 @@ class DB:
 
     _CREATE_MESSAGES_INDEX = 'CREATE INDEX IF NOT EXISTS by_id ON messages(msg_id)'
 
+    _CREATE_PEER_HEALTH_TABLE = (
+        'CREATE TABLE IF NOT EXISTS peer_health'
+        ' (peer_id VARCHAR(40) PRIMARY KEY,'
+        ' srtt REAL,'
+        ' rttvar REAL,'
+        ' failures INTEGER NOT NULL,'
+        ' state VARCHAR(10) NOT NULL,'
+        ' opened_at REAL)'
+    )
+
+    # Keyed by sender too: group recipients ACK with the same msg_id
+    _CREATE_SEEN_TABLE = (
+        'CREATE TABLE IF NOT EXISTS seen'
+        ' (msg_id VARCHAR(40) NOT NULL,'
+        ' msg_type VARCHAR(10) NOT NULL,'
+        ' sender VARCHAR(40) NOT NULL,'
+        ' created_at DATETIME DEFAULT CURRENT_TIMESTAMP,'
+        ' PRIMARY KEY (msg_id, msg_type, sender))'
+    )
+
+    _CREATE_ENVELOPES_TABLE = (
+        'CREATE TABLE IF NOT EXISTS envelopes'
+        ' (msg_id VARCHAR(40) NOT NULL,'
+        ' msg_type VARCHAR(10) NOT NULL,'
+        ' sender VARCHAR(40) NOT NULL,'
+        ' ts REAL NOT NULL,'
+        ' envelope TEXT NOT NULL,'
+        ' PRIMARY KEY (msg_id, msg_type, sender))'
+    )
+
+    _CREATE_ENVELOPES_INDEX = 'CREATE INDEX IF NOT EXISTS by_ts ON envelopes(ts)'
+
+    # What a neighbour may send in sync: sub-bucket paths we sent ids for,
+    # and envelope keys we requested
+    _CREATE_SYNC_EXPECTED_TABLE = (
+        'CREATE TABLE IF NOT EXISTS sync_expected'
+        ' (peer_id VARCHAR(40) NOT NULL,'
+        ' scope TEXT NOT NULL,'
+        ' expires_at REAL NOT NULL,'
+        ' PRIMARY KEY (peer_id, scope))'
+    )
+
+    # Per recipient delivery of sent messages, messages.received is set on any ACK
+    _CREATE_RECEIPTS_TABLE = (
+        'CREATE TABLE IF NOT EXISTS receipts'
+        ' (msg_id VARCHAR(40) NOT NULL,'
+        ' peer_id VARCHAR(40) NOT NULL,'
+        ' received BOOLEAN NOT NULL,'
+        ' PRIMARY KEY (msg_id, peer_id))'
+    )
+
+    _CREATE_GROUPS_TABLE = (
+        'CREATE TABLE IF NOT EXISTS groups'
+        ' (name VARCHAR(40) NOT NULL,'
+        ' peer_id VARCHAR(40) NOT NULL,'
+        ' PRIMARY KEY (name, peer_id))'
+    )
+
+    # Lets daemon workers read while another one writes
+    _ENABLE_WAL = 'PRAGMA journal_mode=WAL'
+
     _INIT_QUERIES = [
+        _ENABLE_WAL,
         _CREATE_SETTINGS_TABLE,
         _CREATE_PEERS_TABLE,
         _CREATE_MESSAGES_TABLE,
         _CREATE_MESSAGES_INDEX,
+        _CREATE_PEER_HEALTH_TABLE,
+        _CREATE_SEEN_TABLE,
+        _CREATE_GROUPS_TABLE,
+        _CREATE_RECEIPTS_TABLE,
+        _CREATE_ENVELOPES_TABLE,
+        _CREATE_ENVELOPES_INDEX,
+        _CREATE_SYNC_EXPECTED_TABLE,
     ]
 
     """Purge"""
 
     _DROP_PEERS_TABLE = 'DROP TABLE IF EXISTS peers'
     _DROP_TABLE_MESSAGES = 'DROP TABLE IF EXISTS MESSAGES'
+    _DROP_PEER_HEALTH_TABLE = 'DROP TABLE IF EXISTS peer_health'
+    _DROP_SEEN_TABLE = 'DROP TABLE IF EXISTS seen'
+    _DROP_GROUPS_TABLE = 'DROP TABLE IF EXISTS groups'
+    _DROP_RECEIPTS_TABLE = 'DROP TABLE IF EXISTS receipts'
+    _DROP_ENVELOPES_TABLE = 'DROP TABLE IF EXISTS envelopes'
+    _DROP_SYNC_EXPECTED_TABLE = 'DROP TABLE IF EXISTS sync_expected'
     _DROP_CURSOR = 'UPDATE SETTINGS SET settings_value = null WHERE settings_key = \'cursor\''
 
     _PURGE_QUERIES = [
         _DROP_PEERS_TABLE,
         _DROP_TABLE_MESSAGES,
+        _DROP_PEER_HEALTH_TABLE,
+        _DROP_SEEN_TABLE,
+        _DROP_GROUPS_TABLE,
+        _DROP_RECEIPTS_TABLE,
+        _DROP_ENVELOPES_TABLE,
+        _DROP_SYNC_EXPECTED_TABLE,
         _DROP_CURSOR,
     ]
 
@@ -103,6 +188,50 @@ class DB:
         ' WHERE name = :old_name'
     )
 
+    """Peer health"""
+
+    _UPSERT_PEER_HEALTH = (
+        'INSERT INTO peer_health (peer_id, srtt, rttvar, failures, state, opened_at)'
+        ' VALUES (:peer_id, :srtt, :rttvar, :failures, :state, :opened_at)'
+        ' ON CONFLICT(peer_id) DO UPDATE SET'
+        ' srtt = :srtt,'
+        ' rttvar = :rttvar,'
+        ' failures = :failures,'
+        ' state = :state,'
+        ' opened_at = :opened_at'
+    )
+
+    _FETCH_ALL_PEER_HEALTH = (
+        'SELECT peer_id, srtt, rttvar, failures, state, opened_at FROM peer_health'
+    )
+
+    _FETCH_PEER_HEALTH = (
+        'SELECT peer_id, srtt, rttvar, failures, state, opened_at FROM peer_health'
+        ' WHERE peer_id = :peer_id'
+    )
+
+    """Groups"""
+
+    _INSERT_GROUP_MEMBER = (
+        'INSERT OR IGNORE INTO groups (name, peer_id) VALUES (:name, :peer_id)'
+    )
+
+    _DELETE_GROUP = 'DELETE FROM groups WHERE name = :name'
+
+    _DELETE_GROUP_MEMBER = 'DELETE FROM groups WHERE name = :name AND peer_id = :peer_id'
+
+    _FETCH_GROUP_MEMBERS = (
+        'SELECT peers.peer_id, peers.name, peers.ip, peers.key'
+        ' FROM groups JOIN peers ON groups.peer_id = peers.peer_id'
+        ' WHERE groups.name = :name'
+    )
+
+    _FETCH_ALL_GROUPS = (
+        'SELECT groups.name, peers.name'
+        ' FROM groups JOIN peers ON groups.peer_id = peers.peer_id'
+        ' ORDER BY groups.name, peers.name'
+    )
+
     """Messages"""
 
     _INSERT_NEW_MESSAGE = (
@@ -135,14 +264,84 @@ class DB:
         ' FROM messages ORDER BY id LIMIT :limit'
     )
 
+    _FETCH_MESSAGE_EXISTS = (
+        'SELECT 1 FROM messages WHERE msg_id = :msg_id AND sender = :sender'
+    )
     _UPDATE_MESSAGE_RECEIVED = (
         'UPDATE messages SET received = true WHERE msg_id = :msg_id'
     )
 
+    _INSERT_RECEIPT = (
+        'INSERT OR IGNORE INTO receipts (msg_id, peer_id, received)'
+        ' VALUES (:msg_id, :peer_id, false)'
+    )
+
+    _UPDATE_RECEIPT_RECEIVED = (
+        'UPDATE receipts SET received = true WHERE msg_id = :msg_id AND peer_id = :peer_id'
+    )
+
+    _FETCH_RECEIPTS = (
+        'SELECT receipts.peer_id, peers.name, receipts.received'
+        ' FROM receipts LEFT JOIN peers ON receipts.peer_id = peers.peer_id'
+        ' WHERE receipts.msg_id = :msg_id'
+        ' ORDER BY peers.name'
+    )
+
+    _INSERT_SEEN = (
+        'INSERT OR IGNORE INTO seen (msg_id, msg_type, sender)'
+        ' VALUES (:msg_id, :msg_type, :sender)'
+    )
+
+    _DELETE_SEEN = (
+        'DELETE FROM seen'
+        ' WHERE msg_id = :msg_id AND msg_type = :msg_type AND sender = :sender'
+    )
+
+    _DELETE_SEEN_OLDER_THAN = (
+        'DELETE FROM seen WHERE created_at < datetime(\'now\', :age)'
+    )
+
+    """Envelopes"""
+
+    _INSERT_ENVELOPE = (
+        'INSERT OR IGNORE INTO envelopes (msg_id, msg_type, sender, ts, envelope)'
+        ' VALUES (:msg_id, :msg_type, :sender, :ts, :envelope)'
+    )
+
+    _FETCH_ENVELOPE = (
+        'SELECT envelope FROM envelopes'
+        ' WHERE msg_id = :msg_id AND msg_type = :msg_type AND sender = :sender'
+    )
+
+    _FETCH_ENVELOPE_EXISTS = (
+        'SELECT 1 FROM envelopes'
+        ' WHERE msg_id = :msg_id AND msg_type = :msg_type AND sender = :sender'
+    )
+    _FETCH_ENVELOPE_KEYS_SINCE = (
+        'SELECT msg_id, msg_type, sender, ts FROM envelopes WHERE ts >= :ts'
+    )
+
+    _DELETE_ENVELOPES_BEFORE = 'DELETE FROM envelopes WHERE ts < :ts'
+
+    _UPSERT_SYNC_EXPECTED = (
+        'INSERT INTO sync_expected (peer_id, scope, expires_at)'
+        ' VALUES (:peer_id, :scope, :expires_at)'
+        ' ON CONFLICT(peer_id, scope) DO UPDATE SET expires_at = :expires_at'
+    )
+    _FETCH_SYNC_EXPECTED = (
+        'SELECT scope FROM sync_expected WHERE peer_id = :peer_id AND expires_at >= :now'
+    )
+    _DELETE_SYNC_EXPECTED_BEFORE = 'DELETE FROM sync_expected WHERE expires_at < :ts'
+
     @staticmethod
     def _execute(query, **kwargs):
         with get_cursor() as cursor:
-            cursor.execute(query, kwargs)
+            return cursor.execute(query, kwargs).lastrowid
+
+    @staticmethod
+    def _execute_many(query, params):
+        with get_cursor() as cursor:
+            cursor.executemany(query, params)
 
     @staticmethod
     def _execute_fetchall(query, **kwargs):
@@ -190,6 +389,16 @@ class DB:
             DB._INSERT_PEER_WITH_KEY, peer_id=peer_id, name=name, ip=ip, key=key
         )
 
+    @staticmethod
+    def add_peers_with_key(peers: list):
+        return DB._execute_many(
+            DB._INSERT_PEER_WITH_KEY,
+            [
+                {'peer_id': peer.peer_id, 'name': peer.name, 'ip': peer.ip, 'key': peer.key}
+                for peer in peers
+            ],
+        )
+
     @staticmethod
     def add_peer_only_required(peer_id: str, name: str):
         return DB._execute(DB._INSERT_PEER_ONLY_REQUIRED, peer_id=peer_id, name=name)
@@ -234,6 +443,57 @@ class DB:
             new_key=new_key,
         )
 
+    """Peer health"""
+
+    @staticmethod
+    def upsert_peer_health(peer_id, srtt, rttvar, failures, state, opened_at):
+        return DB._execute(
+            DB._UPSERT_PEER_HEALTH,
+            peer_id=peer_id,
+            srtt=srtt,
+            rttvar=rttvar,
+            failures=failures,
+            state=state,
+            opened_at=opened_at,
+        )
+
+    @staticmethod
+    def fetch_peer_health(peer_id):
+        return DB._execute_fetchone(DB._FETCH_PEER_HEALTH, peer_id=peer_id)
+
+    @staticmethod
+    def fetch_all_peer_health():
+        return DB._execute_fetchall(DB._FETCH_ALL_PEER_HEALTH)
+
+    """Groups"""
+
+    @staticmethod
+    def add_group_members(name: str, peer_ids: list):
+        return DB._execute_many(
+            DB._INSERT_GROUP_MEMBER,
+            [{'name': name, 'peer_id': peer_id} for peer_id in peer_ids],
+        )
+
+    @staticmethod
+    def delete_group(name: str):
+        return DB._execute(DB._DELETE_GROUP, name=name)
+
+    @staticmethod
+    def delete_group_members(name: str, peer_ids: list):
+        return DB._execute_many(
+            DB._DELETE_GROUP_MEMBER,
+            [{'name': name, 'peer_id': peer_id} for peer_id in peer_ids],
+        )
+
+    @staticmethod
+    def fetch_group_members(name: str):
+        rows = DB._execute_fetchall(DB._FETCH_GROUP_MEMBERS, name=name)
+        return [models.Peer(*row) for row in rows]
+
+    @staticmethod
+    def fetch_all_groups():
+        return DB._execute_fetchall(DB._FETCH_ALL_GROUPS)
+
     """Messages"""
 
     @staticmethod
@@ -250,6 +510,16 @@ class DB:
             decrypted=decrypted,
         )
 
+    @staticmethod
+    def insert_messages(messages: list):
+        return DB._execute_many(
+            DB._INSERT_NEW_MESSAGE,
+            [
+                dict(dict(received=False, seen=False, decrypted=False), **msg)
+                for msg in messages
+            ],
+        )
+
     @staticmethod
     def fetch_all_messages(limit):
         return DB._execute_fetchall(DB._FETCH_ALL_MESSAGES, limit=limit)
@@ -258,10 +528,100 @@ class DB:
     def fetch_messages_by_cursor(cursor):
         return DB._execute_fetchall(DB._FETCH_UNREAD_MESSAGES, id=cursor)
 
+    @staticmethod
+    def has_message(msg_id, sender):
+        row = DB._execute_fetchone(DB._FETCH_MESSAGE_EXISTS, msg_id=msg_id, sender=sender)
+        return row is not None
+
     @staticmethod
     def update_message_received(msg_id):
         return DB._execute(DB._UPDATE_MESSAGE_RECEIVED, msg_id=msg_id)
 
+    @staticmethod
+    def add_receipts(receipts: list):
+        return DB._execute_many(
+            DB._INSERT_RECEIPT,
+            [{'msg_id': msg_id, 'peer_id': peer_id} for msg_id, peer_id in receipts],
+        )
+
+    @staticmethod
+    def update_receipt_received(msg_id, peer_id):
+        return DB._execute(DB._UPDATE_RECEIPT_RECEIVED, msg_id=msg_id, peer_id=peer_id)
+
+    @staticmethod
+    def fetch_receipts(msg_id):
+        return DB._execute_fetchall(DB._FETCH_RECEIPTS, msg_id=msg_id)
+
+    @staticmethod
+    def mark_seen(msg_id, msg_type, sender):
+        # False if some daemon worker has seen this message already
+        with get_cursor() as cursor:
+            return cursor.execute(
+                DB._INSERT_SEEN, {'msg_id': msg_id, 'msg_type': msg_type, 'sender': sender}
+            ).rowcount == 1
+
+    @staticmethod
+    def unmark_seen(msg_id, msg_type, sender):
+        return DB._execute(DB._DELETE_SEEN, msg_id=msg_id, msg_type=msg_type, sender=sender)
+
+    @staticmethod
+    def delete_seen_older_than(seconds):
+        return DB._execute(DB._DELETE_SEEN_OLDER_THAN, age=f'-{seconds} seconds')
+
+    """Envelopes"""
+
+    @staticmethod
+    def insert_envelope(msg_id, msg_type, sender, ts, envelope: dict):
+        return DB._execute(
+            DB._INSERT_ENVELOPE,
+            msg_id=msg_id,
+            msg_type=msg_type,
+            sender=sender,
+            ts=ts,
+            envelope=json.dumps(envelope),
+        )
+
+    @staticmethod
+    def fetch_envelope(msg_id, msg_type, sender):
+        row = DB._execute_fetchone(
+            DB._FETCH_ENVELOPE, msg_id=msg_id, msg_type=msg_type, sender=sender
+        )
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def has_envelope(msg_id, msg_type, sender):
+        row = DB._execute_fetchone(
+            DB._FETCH_ENVELOPE_EXISTS, msg_id=msg_id, msg_type=msg_type, sender=sender
+        )
+        return row is not None
+
+    @staticmethod
+    def fetch_envelope_keys_since(ts):
+        return DB._execute_fetchall(DB._FETCH_ENVELOPE_KEYS_SINCE, ts=ts)
+
+    @staticmethod
+    def delete_envelopes_before(ts):
+        return DB._execute(DB._DELETE_ENVELOPES_BEFORE, ts=ts)
+
+    @staticmethod
+    def add_sync_expected(peer_id, scopes, expires_at):
+        return DB._execute_many(
+            DB._UPSERT_SYNC_EXPECTED,
+            [
+                {'peer_id': peer_id, 'scope': scope, 'expires_at': expires_at}
+                for scope in scopes
+            ],
+        )
+
+    @staticmethod
+    def fetch_sync_expected(peer_id, now):
+        rows = DB._execute_fetchall(DB._FETCH_SYNC_EXPECTED, peer_id=peer_id, now=now)
+        return {row[0] for row in rows}
+
+    @staticmethod
+    def delete_sync_expected_before(ts):
+        return DB._execute(DB._DELETE_SYNC_EXPECTED_BEFORE, ts=ts)
+
 
 def get_peer_id():
     return DB.fetch_setting('peer_id')[0]
@@ -274,3 +634,9 @@ def get_msg_cursor():
 
 def update_msg_cursor(cursor):
     return DB.insert_setting('cursor', cursor)
+
+
+def store_envelope(msg: dict):
+    # Kept for anti-entropy sync, messages without sender timestamp cannot be bucketed
+    if 'ts' in msg:
+        DB.insert_envelope(msg['id'], msg['type'], msg['from'], msg['ts'], msg)
@@ -1,3 +1,5 @@
+import functools
+
 from cryptography.fernet import Fernet
 
 
@@ -14,3 +16,8 @@ class Encryptor:
 
     def decrypt(self, message: bytes) -> bytes:
         return self.encryptor.decrypt(message)
+
+
+@functools.lru_cache(maxsize=256)
+def get_encryptor(secret) -> Encryptor:
+    return Encryptor(secret)
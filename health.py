@@ -0,0 +1,172 @@
+import threading
+import time
+
+import consts
+import db
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class PeerHealth:
+    '''
+    RTT estimate and circuit breaker state of one peer.
+
+    RTT is smoothed like TCP does (RFC 6298), and the connect/send timeout
+    is derived from it. The timeout doubles on every consecutive failure,
+    so a link that became slower still gets through. After
+    BREAKER_FAILURES consecutive failures the breaker opens and the peer
+    is skipped. Once BREAKER_COOLDOWN passes, one probe is let through
+    (half-open) with the longest timeout: success closes the breaker,
+    failure opens it again.
+    '''
+
+    def __init__(
+        self, peer_id, srtt=None, rttvar=None, failures=0, state=CLOSED, opened_at=None
+    ):
+        self.peer_id = peer_id
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.failures = failures
+        self.state = state
+        self.opened_at = opened_at
+        self.probing = False
+        self.persisted_at = 0.0
+        self.refreshed_at = time.monotonic()
+
+    def refresh(self, row):
+        '''
+        Take breaker state written by other processes (daemon workers).
+        '''
+        self.refreshed_at = time.monotonic()
+        if row is None:
+            return
+        srtt, rttvar, self.failures, state, self.opened_at = row[1:]
+        if self.srtt is None:
+            self.srtt, self.rttvar = srtt, rttvar
+        if state != self.state:
+            self.probing = False
+        self.state = state
+
+    def timeout(self):
+        if self.state != CLOSED:
+            return consts.SCK_MAX_TIMEOUT
+        if self.srtt is None:
+            rto = consts.SCK_TIMEOUT
+        else:
+            rto = max(self.srtt + 4 * self.rttvar, consts.SCK_MIN_TIMEOUT)
+        # Back off like RFC 6298 (5.5), failures are few while closed
+        rto *= 2 ** min(self.failures, consts.BREAKER_FAILURES)
+        return min(rto, consts.SCK_MAX_TIMEOUT)
+
+    def allow(self, now):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now - self.opened_at >= consts.BREAKER_COOLDOWN:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.failures = 0
+        self.probing = False
+        self.state = CLOSED
+
+    def record_failure(self, now):
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or self.failures >= consts.BREAKER_FAILURES:
+            self.state = OPEN
+            self.opened_at = now
+
+    def to_tuple(self):
+        rtt = '-' if self.srtt is None else '{:.1f}'.format(self.srtt * 1000)
+        return self.state, rtt, self.failures
+
+
+class Tracker:
+    '''
+    In-memory health of all peers, backed by the `peer_health` table.
+
+    Breaker state is shared between processes through the table: failures
+    and transitions are written at once, and re-read before they are
+    counted and at most every HEALTH_REFRESH_INTERVAL seconds otherwise.
+    RTT is written every HEALTH_PERSIST_INTERVAL seconds, last writer wins.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.peers = None
+        # Called with peer_id when a peer with open breaker answers again
+        self.on_recovered = None
+
+    def _get(self, peer_id) -> PeerHealth:
+        if self.peers is None:
+            self.peers = {row[0]: PeerHealth(*row) for row in db.DB.fetch_all_peer_health()}
+        if peer_id not in self.peers:
+            self.peers[peer_id] = PeerHealth(peer_id)
+        return self.peers[peer_id]
+
+    def _get_fresh(self, peer_id, force=False) -> PeerHealth:
+        health = self._get(peer_id)
+        if force or time.monotonic() - health.refreshed_at >= consts.HEALTH_REFRESH_INTERVAL:
+            health.refresh(db.DB.fetch_peer_health(peer_id))
+        return health
+
+    def get(self, peer_id) -> PeerHealth:
+        with self.lock:
+            return self._get_fresh(peer_id)
+
+    def allow(self, peer_id):
+        with self.lock:
+            return self._get_fresh(peer_id).allow(time.time())
+
+    def is_closed(self, peer_id):
+        '''Check breaker without taking the half-open probe.'''
+        with self.lock:
+            return self._get_fresh(peer_id).state == CLOSED
+
+    def timeout(self, peer_id):
+        with self.lock:
+            return self._get_fresh(peer_id).timeout()
+
+    def record_success(self, peer_id, rtt):
+        with self.lock:
+            health = self._get(peer_id)
+            state, failures = health.state, health.failures
+            health.record_success(rtt)
+        self._persist(health, force=state != health.state or failures != health.failures)
+        if state != CLOSED and self.on_recovered is not None:
+            self.on_recovered(peer_id)
+
+    def record_failure(self, peer_id):
+        with self.lock:
+            # Count failures seen by other workers too
+            health = self._get_fresh(peer_id, force=True)
+            health.record_failure(time.time())
+        self._persist(health, force=True)
+
+    def _persist(self, health: PeerHealth, force):
+        now = time.time()
+        if not force and now - health.persisted_at < consts.HEALTH_PERSIST_INTERVAL:
+            return
+        health.persisted_at = now
+        db.DB.upsert_peer_health(
+            health.peer_id,
+            health.srtt,
+            health.rttvar,
+            health.failures,
+            health.state,
+            health.opened_at,
+        )
+
+
+tracker = Tracker()
@@ -1,6 +1,8 @@
 # must import it first
 import log
 
+import csv
+import json
 import logging
 import os
 import signal
@@ -12,9 +14,12 @@ import uuid
 import click
 import tabulate
 
+import backpressure
 import db
 import consts
+import control
 import encryption
+import health
 import models
 import transport
 
@@ -28,6 +33,8 @@ def init():
         db.DB.initialize()
         db.DB.insert_setting('peer_id', uuid.uuid4().hex)
         return True
+    # Create tables added since the DB was made
+    db.DB.initialize()
     return False
 
 
@@ -65,10 +72,23 @@ def daemon_group():
 
 
 @daemon_group.command('up')
-def daemon_up():
+@click.option(
+    '--workers',
+    type=click.IntRange(1, consts.MAX_WORKERS),
+    default=1,
+    help='Number of worker processes sharing the daemon port',
+)
+def daemon_up(workers):
     try:
         p = subprocess.Popen(
-            [sys.executable, './server.py', consts.DAEMON_HOST, consts.DAEMON_PORT],
+            [
+                sys.executable,
+                './server.py',
+                consts.DAEMON_HOST,
+                consts.DAEMON_PORT,
+                '--workers',
+                str(workers),
+            ],
             cwd='.',
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
@@ -121,6 +141,20 @@ def daemon_down():
     db.DB.delete_setting('daemon')
 
 
+@daemon_group.command('stats')
+def daemon_stats():
+    response = control.stats()
+    if response is None:
+        logging.info('Daemon is not running')
+        return
+    if not response['ok']:
+        logging.error('Daemon could not report counters: %s', response['error'])
+        return
+    print(
+        tabulate.tabulate(sorted(response['counters'].items()), headers=['Counter', 'Value'])
+    )
+
+
 @cli.group('peer')
 def peers_group():
     """Manage peers"""
@@ -158,13 +192,108 @@ def add_peer(peer_id, name, ip, key_file, key, auto):
     db.DB.add_peer_with_key(peer_id, name, ip, peer_key)
 
 
+PEER_FIELDS = ['peer_id', 'name', 'ip', 'key']
+
+
+def guess_format(file, fmt):
+    if fmt:
+        return fmt
+    return 'csv' if file.name.endswith('.csv') else 'jsonl'
+
+
+@peers_group.command('import')
+@click.argument('file', type=click.File('r'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default=None)
+@click.option('--auto', is_flag=True, help='Generate keys for peers without one')
+def import_peers(file, fmt, auto):
+    if guess_format(file, fmt) == 'csv':
+        reader = csv.DictReader(file)
+        rows = ((reader.line_num, row) for row in reader)
+    else:
+        rows = ((line_no, line) for line_no, line in enumerate(file, start=1) if line.strip())
+
+    peers = []
+    generated = 0
+    line_no = 0
+    try:
+        for line_no, row in rows:
+            if isinstance(row, str):
+                row = json.loads(row)
+            if not isinstance(row, dict) or not row.get('peer_id') or not row.get('name'):
+                raise ValueError('expected object with at least peer_id and name')
+            peer = models.Peer(
+                row['peer_id'], row['name'], row.get('ip') or None, row.get('key') or None
+            )
+            if not peer.key:
+                if not auto:
+                    logging.error(
+                        'Line %s: peer \'%s\' has no key, pass \'--auto\' to generate. '
+                        'Nothing was imported',
+                        line_no,
+                        peer.name,
+                    )
+                    return
+                peer.key = encryption.generate_key()
+                generated += 1
+            peers.append(peer)
+    except (ValueError, csv.Error) as exc:
+        logging.error('Line %s: %s. Nothing was imported', line_no, str(exc))
+        return
+
+    try:
+        db.DB.add_peers_with_key(peers)
+    except sqlite3.IntegrityError as exc:
+        logging.error('Could not import peers, nothing was added: %s', str(exc))
+        return
+    logging.info('Imported %s peers', len(peers))
+    if generated:
+        logging.warning(
+            'Generated new keys for %s peers: share them with those peers, '
+            'messages encrypted with their old keys cannot be read',
+            generated,
+        )
+
+
+@peers_group.command('export')
+@click.argument('file', type=click.File('w'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default=None)
+@click.option('--show-key', is_flag=True)
+def export_peers(file, fmt, show_key):
+    if not show_key:
+        logging.warning(
+            'Keys are not exported, pass \'--show-key\' to include them. '
+            'Importing this file needs \'--auto\', which generates new keys'
+        )
+    rows = [
+        {
+            'peer_id': peer.peer_id,
+            'name': peer.name,
+            'ip': peer.ip,
+            'key': peer.key if show_key else None,
+        }
+        for peer in db.DB.fetch_all_peers()
+    ]
+    if guess_format(file, fmt) == 'csv':
+        writer = csv.DictWriter(file, fieldnames=PEER_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            file.write(json.dumps(row) + '\n')
+
+
 @peers_group.command('show')
 @click.argument('name', type=str, default=None, required=False)
 @click.argument('peer_id', type=str, default=None, required=False)
 @click.option('--show-key', is_flag=True)
 def show_peer(name, peer_id, show_key):
     def display_peers(peers: list):
-        print(tabulate.tabulate(peers, headers=['Peer ID', 'Name', 'IP', 'Key']))
+        print(
+            tabulate.tabulate(
+                peers,
+                headers=['Peer ID', 'Name', 'IP', 'Key', 'Health', 'RTT (ms)', 'Failures'],
+            )
+        )
 
     if not name and not peer_id and not peer_id:
         all_peers = db.DB.fetch_all_peers()
@@ -180,7 +309,9 @@ def show_peer(name, peer_id, show_key):
         return
     if show_key:
         all_peers = list(map(lambda x: x.show_key(), all_peers))
-    display_peers(list(map(lambda x: x.to_tuple(), all_peers)))
+    display_peers(
+        [peer.to_tuple() + health.tracker.get(peer.peer_id).to_tuple() for peer in all_peers]
+    )
 
 
 @peers_group.command('edit')
@@ -206,6 +337,59 @@ def edit_peer(peer_name, id, name, ip, key):
     db.DB.update_peer(peer_name, peer.peer_id, peer.name, peer.ip, peer.key)
 
 
+@cli.group('group')
+def groups_group():
+    """Manage named groups of peers"""
+    pass
+
+
+def fetch_peers_by_names(names):
+    peers = []
+    for name in names:
+        peer = db.DB.fetch_peer_by_name(name)
+        if not peer:
+            logging.info('Could not find peer \'%s\'', name)
+            return None
+        peers.append(peer)
+    return peers
+
+
+@groups_group.command('add')
+@click.argument('group')
+@click.argument('peer_names', nargs=-1, required=True)
+def add_group_members(group, peer_names):
+    peers = fetch_peers_by_names(peer_names)
+    if peers is None:
+        return
+    db.DB.add_group_members(group, [peer.peer_id for peer in peers])
+
+
+@groups_group.command('remove')
+@click.argument('group')
+@click.argument('peer_names', nargs=-1)
+def remove_group_members(group, peer_names):
+    """Remove peers from group, or whole group if no peers are given"""
+    if not peer_names:
+        db.DB.delete_group(group)
+        return
+    peers = fetch_peers_by_names(peer_names)
+    if peers is None:
+        return
+    db.DB.delete_group_members(group, [peer.peer_id for peer in peers])
+
+
+@groups_group.command('show')
+@click.argument('group', type=str, default=None, required=False)
+def show_groups(group):
+    rows = db.DB.fetch_all_groups()
+    if group:
+        rows = [row for row in rows if row[0] == group]
+    if not rows:
+        print('Could not find groups')
+        return
+    print(tabulate.tabulate(rows, headers=['Group', 'Peer']))
+
+
 @cli.group('message')
 def message():
     """Manage messaged"""
@@ -220,22 +404,122 @@ def send_message(name):
         return
 
     text = input('Enter your message: ')
-    transmitter = transport.Transmitter()
-    msg = {
-        'id': uuid.uuid4().hex,
-        'type': models.MessageType.MESSAGE.value,
-        'body': text,
-    }
-    db.DB.insert_message(
-        msg['id'], db.get_peer_id(), text, received=False, seen=False, decrypted=True
-    )
-    success = transmitter.transmit(peer, msg)
+    response = control.send(name, text)
+    if response is None:
+        logging.debug('Daemon is not running, sending directly')
+        success = transport.Transmitter().send_message(peer, text)
+    elif not response['ok']:
+        logging.error('Daemon could not send message: %s', response['error'])
+        return
+    else:
+        success = response['success']
     if not success:
         logging.warning('Could not transmit message to anybody')
         return
     logging.info('Transmitted msg to %s peers', success)
 
 
+@message.command('send-group')
+@click.argument('names', nargs=-1)
+@click.option('--group', type=str, default=None, help='Send to members of group too')
+def send_group_message(names, group):
+    """Send one message to several peers with a single flood"""
+    names = list(names)
+    if group:
+        names += [peer.name for peer in db.DB.fetch_group_members(group)]
+    names = list(dict.fromkeys(names))
+    if not names:
+        logging.info('Pass peer names or \'--group\' with members')
+        return
+    peers = fetch_peers_by_names(names)
+    if peers is None:
+        return
+
+    text = input('Enter your message: ')
+    response = control.send_group(names, text)
+    if response is None:
+        logging.debug('Daemon is not running, sending directly')
+        success = transport.Transmitter().send_group_message(peers, text)
+    elif not response['ok']:
+        logging.error('Daemon could not send message: %s', response['error'])
+        return
+    else:
+        success = response['success']
+    if not success:
+        logging.warning('Could not transmit message to anybody')
+        return
+    logging.info('Transmitted msg for %s recipients to %s peers', len(peers), success)
+
+
+@message.command('send-bulk')
+@click.argument('file', type=click.File('r'), default='-')
+def send_bulk(file):
+    """Send JSONL messages: one {"to": <name>, "body": <text>} per line"""
+    peers = {peer.name: peer for peer in db.DB.fetch_all_peers()}
+    transmitter = transport.Transmitter()
+    # Neighbours silently drop whatever exceeds their per-origin limit
+    pacer = backpressure.TokenBucket(consts.ORIGIN_RATE_LIMIT, 1)
+    batch = []
+    sent, unreached = 0, 0
+
+    def flush():
+        nonlocal sent, unreached
+        if not batch:
+            return
+        for success in transmitter.send_messages(batch, pacer):
+            sent += 1
+            unreached += not success
+        batch.clear()
+
+    for line_no, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            name, text = item['to'], item['body']
+        except (ValueError, KeyError, TypeError):
+            logging.warning('Skip line %s: expected {"to": ..., "body": ...}', line_no)
+            continue
+        if name not in peers:
+            logging.warning('Skip line %s: could not find peer \'%s\'', line_no, name)
+            continue
+        batch.append((peers[name], text))
+        if len(batch) >= consts.BULK_BATCH_SIZE:
+            flush()
+    flush()
+
+    logging.info('Sent %s messages, %s could not be transmitted to anybody', sent, unreached)
+
+
+@message.command('watch')
+def watch_messages():
+    messages = control.watch()
+    if messages is None:
+        logging.info('Daemon is not running')
+        return
+    try:
+        for msg in messages:
+            print('{}: {}'.format(msg['sender'], msg['body']), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+@message.command('receipts')
+@click.argument('msg_id')
+def show_receipts(msg_id):
+    """Show which recipients of sent message ACKed it"""
+    receipts = db.DB.fetch_receipts(msg_id)
+    if not receipts:
+        print('Could not find receipts')
+        return
+    print(
+        tabulate.tabulate(
+            [(peer_id, name, '✔' if received else '×') for peer_id, name, received in receipts],
+            headers=['Peer ID', 'Name', 'Received'],
+        )
+    )
+
+
 @message.command('read')
 @click.option('-a', '--all', is_flag=True)
 @click.option('--limit', type=int, default=10)
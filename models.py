@@ -26,4 +26,9 @@ class Peer:
 
 class MessageType(enum.Enum):
     MESSAGE = 'MESSAGE'
+    GROUP = 'GROUP'
     ACK = 'ACK'
+    SYNC_DIGEST = 'SYNC_DIGEST'
+    SYNC_IDS = 'SYNC_IDS'
+    SYNC_REQUEST = 'SYNC_REQUEST'
+    SYNC_ENVELOPES = 'SYNC_ENVELOPES'
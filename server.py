@@ -1,20 +1,71 @@
 import argparse
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import signal
 import socketserver
+import sys
 import threading
+import time
 import traceback
 
+import backpressure
+import chain
+import consts
+import control
 import db
 import encryption
+import health
 import models
+import sync
 import transport
 
 
 logging.basicConfig(level=logging.INFO, filename='server.log')
 
 
+def addressed_to(data, peer_id):
+    if data['type'] == models.MessageType.GROUP.value:
+        return peer_id in data['to']
+    return peer_id == data['to']
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, handler, workers=1):
+        # Lets every daemon worker bind the same port, kernel balances
+        # connections. Single daemon must own the port, so a second one fails
+        self.allow_reuse_port = workers > 1
+        # Limits are per daemon, so every worker takes its share. Burst below
+        # one token would reject everything
+        self.peer_limiter = backpressure.RateLimiter(
+            consts.PEER_RATE_LIMIT / workers, max(1, consts.PEER_RATE_BURST / workers)
+        )
+        self.origin_limiter = backpressure.RateLimiter(
+            consts.ORIGIN_RATE_LIMIT / workers, max(1, consts.ORIGIN_RATE_BURST / workers)
+        )
+        self.work_queue = backpressure.WorkQueue(consts.WORK_QUEUE_SIZE)
+        # Slow or stalled peer holds one reader, not the whole server
+        self.readers = threading.BoundedSemaphore(consts.READ_WORKERS)
+        super().__init__(server_address, handler)
+
+    def process_request(self, request, client_address):
+        if not self.readers.acquire(blocking=False):
+            backpressure.counters.incr('rejected_busy')
+            logging.warning('Drop connection from %s: all readers are busy', client_address[0])
+            self.shutdown_request(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.readers.release()
+
+
 class MyTCPHandler(socketserver.BaseRequestHandler):
     '''
     The request handler class for our server.
@@ -34,17 +85,74 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
                 self.client_address[0],
             )
             return
+        # Reject before paying for decryption
+        if not self.server.peer_limiter.allow(peer.peer_id):
+            backpressure.counters.incr('rejected_peer_rate')
+            logging.warning('Drop request: peer %s exceeds rate limit', peer.name)
+            return
         tcp = transport.Transport(self.request, peer)
-        data = tcp.receive_all()
+        try:
+            data = tcp.receive_all(consts.MAX_MESSAGE_SIZE, consts.SCK_READ_TIMEOUT)
+        except (OSError, ValueError) as exc:
+            backpressure.counters.incr('rejected_read')
+            logging.warning('Drop request from %s: %s', peer.name, exc)
+            return
         logging.info(
             'Received message from ip=%s, msg=%s', self.client_address[0], data
         )
-        try:
-            self.dispatch(data)
-        except Exception as exc:  # noqa
-            logging.error(traceback.format_exc())
+        if not self.allow_origin(data['from']):
+            return
+        if data['type'] == models.MessageType.SYNC_ENVELOPES.value:
+            # Each synced envelope is a message of its own origin
+            data['envelopes'] = [
+                envelope
+                for envelope in data['envelopes'][: consts.SYNC_MAX_ENVELOPES]
+                if self.allow_origin(envelope.get('from'))
+            ]
+        local = addressed_to(data, db.get_peer_id())
+        if not self.server.work_queue.put(data, local):
+            logging.warning('Drop message: work queue is full, msg_id=%s', data['id'])
+
+    def allow_origin(self, origin):
+        if self.server.origin_limiter.allow(origin):
+            return True
+        backpressure.counters.incr('rejected_origin_rate')
+        logging.warning('Drop message: origin %s exceeds rate limit', origin)
+        return False
+
+
+class Dispatcher:
+    '''
+    Processes received messages taken from the server work queue.
+    '''
+
+    def __init__(self):
+        self.pruned_at = time.monotonic()
+
+    def run(self, work_queue: backpressure.WorkQueue):
+        while True:
+            data = work_queue.get()
+            if data is None:
+                return
+            try:
+                self.prune()
+                self.dispatch(data)
+                backpressure.counters.incr('dispatched')
+            except Exception as exc:  # noqa
+                logging.error(traceback.format_exc())
+
+    def prune(self):
+        now = time.monotonic()
+        if now - self.pruned_at < consts.SEEN_PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        db.DB.delete_seen_older_than(consts.SEEN_TTL)
 
-    def dispatch(self, data):
+    def dispatch(self, data, synced=False):
+        '''
+        Handle a received message. Messages `synced` from a neighbour are
+        late copies of a flood, so they are not flooded again.
+        '''
         msg_type = data['type']
         peer = db.DB.fetch_peer_by_id(data['from'])
         my_peer_id = db.get_peer_id()
@@ -52,13 +160,61 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
             db.DB.add_peer_only_required(data['from'], data['from'])
             peer = db.DB.fetch_peer_by_id(data['from'])
 
-        if my_peer_id in data['chain']:
+        try:
+            msg_chain = chain.Chain.decode(data['chain'])
+        except ValueError as exc:
+            logging.warning('Drop message, because its chain is malformed: %s', exc)
+            return
+        if my_peer_id in msg_chain:
             logging.info('Drop message, because I(%s) am in chain already', my_peer_id)
             return
+        if msg_type in sync.SYNC_TYPES:
+            # Sync is between neighbours only, never relayed
+            if my_peer_id != data['to']:
+                return
+            if msg_type == models.MessageType.SYNC_ENVELOPES.value:
+                self.dispatch_envelopes(data['envelopes'], peer)
+            else:
+                sync.syncer.handle(data, peer)
+            return
+        # Same message may arrive over several paths or to several workers.
+        # Seen marks expire long before stored envelopes stop being synced
+        if db.DB.has_envelope(data['id'], msg_type, data['from']) or not db.DB.mark_seen(
+            data['id'], msg_type, data['from']
+        ):
+            logging.info('Drop message, because it was seen already')
+            return
+        envelope = dict(data)
+        try:
+            self.handle(data, peer, my_peer_id, relay=not synced)
+        except Exception:
+            # Let a later flood or sync deliver it again
+            db.DB.unmark_seen(data['id'], msg_type, data['from'])
+            raise
+        db.store_envelope(envelope)
+
+    def dispatch_envelopes(self, envelopes, peer):
+        accepted = sync.syncer.accept(peer, envelopes)
+        logging.info(
+            'Dispatching %s envelopes from sync, %s unasked dropped',
+            len(accepted),
+            len(envelopes) - len(accepted),
+        )
+        for envelope in accepted:
+            # One broken envelope must not lose the rest
+            try:
+                self.dispatch(envelope, synced=True)
+            except Exception:  # noqa
+                logging.error(traceback.format_exc())
+
+    def handle(self, data, peer, my_peer_id, relay=True):
+        msg_type = data['type']
+        if msg_type == models.MessageType.GROUP.value:
+            self.handle_group(data, peer, my_peer_id, relay)
+            return
         if my_peer_id != data['to']:
-            logging.info('Retransmitting message')
-            transmitter = transport.Transmitter()
-            transmitter.retransmit(data)
+            if relay:
+                self.relay(data)
             return
 
         if msg_type == models.MessageType.MESSAGE.value:
@@ -66,11 +222,40 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
         elif msg_type == models.MessageType.ACK.value:
             self.handle_ack(data, peer)
 
+    def relay(self, data):
+        if data['ttl'] <= 1:
+            logging.info('Drop message, because hop limit is reached')
+            return
+        logging.info('Retransmitting message')
+        transmitter = transport.Transmitter()
+        transmitter.retransmit(data)
+
+    def handle_group(self, data, peer, my_peer_id, relay=True):
+        if my_peer_id in data['to']:
+            logging.info('Handling my part of group message..')
+            self.handle_message(dict(data, body=data['bodies'][my_peer_id]), peer)
+            # Others do not need my part, forward the rest only
+            data = dict(
+                data,
+                to=[peer_id for peer_id in data['to'] if peer_id != my_peer_id],
+                bodies={
+                    peer_id: body
+                    for peer_id, body in data['bodies'].items()
+                    if peer_id != my_peer_id
+                },
+            )
+        if data['to'] and relay:
+            self.relay(data)
+
     def handle_message(self, data, peer):
         logging.info('Handling message..')
 
-        self.save_message(data)
-        logging.info('Saved message')
+        # Redelivered after a failure past saving, e.g. in sending ACK
+        if db.DB.has_message(data['id'], data['from']):
+            logging.info('Message was saved already')
+        else:
+            self.save_message(data)
+            logging.info('Saved message')
         msg = {'id': data['id'], 'type': models.MessageType.ACK.value}
 
         transmitter = transport.Transmitter()
@@ -78,7 +263,8 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
         return
 
     def handle_ack(self, data, peer):
-        logging.info('Received ACK for msg_id=%s', data['id'])
+        logging.info('Received ACK for msg_id=%s from %s', data['id'], data['from'])
+        db.DB.update_receipt_received(data['id'], data['from'])
         db.DB.update_message_received(data['id'])
 
     def save_message(self, data):
@@ -88,7 +274,7 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
         peer = db.DB.fetch_peer_by_id(data['from'])
         if peer:
             body = (
-                encryption.Encryptor(peer.key)
+                encryption.get_encryptor(peer.key)
                 .decrypt(bytes(body, encoding='utf-8'))
                 .decode('utf-8')
             )
@@ -96,7 +282,7 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
         else:
             db.DB.add_peer_only_required(data['from'], data['from'])
 
-        db.DB.insert_message(
+        row_id = db.DB.insert_message(
             data['id'],
             data['from'],
             body,
@@ -104,30 +290,223 @@ class MyTCPHandler(socketserver.BaseRequestHandler):
             seen=False,
             decrypted=decrypted,
         )
+        control.hub.publish(
+            {
+                'id': row_id,
+                'msg_id': data['id'],
+                'sender': data['from'],
+                'body': body,
+                'decrypted': decrypted,
+            }
+        )
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('host')
-    parser.add_argument('port', type=int)
+def start_dispatchers(work_queue: backpressure.WorkQueue):
+    threads = [
+        threading.Thread(target=Dispatcher().run, args=(work_queue,))
+        for _ in range(consts.DISPATCH_WORKERS)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
 
-    args = parser.parse_args()
-    host, port = args.host, args.port
+
+def start_syncer(stopped: threading.Event, periodic):
+    health.tracker.on_recovered = sync.syncer.request_sync
+    thread = threading.Thread(target=sync.syncer.run, args=(stopped, periodic))
+    thread.start()
+    return thread
+
+
+def run_single(host, port):
+    stopped = threading.Event()
 
     # Create the server, binding to localhost on port 9999
-    with socketserver.TCPServer((host, port), MyTCPHandler) as server:
+    with Server(
+        (host, port), MyTCPHandler
+    ) as server, control.ControlServer(consts.CONTROL_SOCKET) as control_server:
 
         def signal_handler(sig, frame):
             logging.info(
                 'Server gracefully shutting down; thread_id=%s',
+                threading.get_ident(),
             )
+            stopped.set()
+            control_server.shutdown()
             server.shutdown()
+            server.work_queue.close()
             logging.info('Server shut down')
 
         server_thread = threading.Thread(target=server.serve_forever)
+        control_thread = threading.Thread(target=control_server.serve_forever)
         signal.signal(signal.SIGTERM, signal_handler)
         logging.info('Start server, pid=%s', os.getpid())
         server_thread.start()
+        control_thread.start()
+        dispatcher_threads = start_dispatchers(server.work_queue)
+        sync_thread = start_syncer(stopped, periodic=True)
+
+        signal.pause()
+        server_thread.join()
+        control_thread.join()
+        sync_thread.join()
+        for thread in dispatcher_threads:
+            thread.join()
+
+
+def run_worker(host, port, index, workers, events: multiprocessing.Queue):
+    control.hub.forward_to(events)
+    stopped = threading.Event()
+
+    def report_counters():
+        while not stopped.wait(consts.COUNTERS_REPORT_INTERVAL):
+            events.put(('counters', os.getpid(), backpressure.counters.snapshot()))
+
+    with Server((host, port), MyTCPHandler, workers) as server:
+
+        def signal_handler(sig, frame):
+            logging.info('Worker gracefully shutting down; pid=%s', os.getpid())
+            stopped.set()
+            server.shutdown()
+            server.work_queue.close()
+
+        server_thread = threading.Thread(target=server.serve_forever)
+        reporter_thread = threading.Thread(target=report_counters)
+        signal.signal(signal.SIGTERM, signal_handler)
+        logging.info('Start worker, pid=%s', os.getpid())
+        server_thread.start()
+        reporter_thread.start()
+        dispatcher_threads = start_dispatchers(server.work_queue)
+        # Every worker syncs with peers it sees recover, one does full rounds
+        sync_thread = start_syncer(stopped, periodic=index == 0)
 
         signal.pause()
         server_thread.join()
+        reporter_thread.join()
+        sync_thread.join()
+        for thread in dispatcher_threads:
+            thread.join()
+
+
+class Supervisor:
+    '''
+    Runs daemon workers as separate processes, each accepting connections
+    on the same port, and restarts the ones that crash.
+
+    Workers share state through the DB. The supervisor owns the control
+    socket: workers send it saved messages and counters over a queue.
+    '''
+
+    def __init__(self, host, port, workers):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        # Workers are restarted while supervisor threads run, fork is unsafe then
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self.processes = {}
+        self.stopping = threading.Event()
+
+    def start_worker(self, index):
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.host, self.port, index, self.workers, self.events),
+        )
+        process.start()
+        self.processes[index] = process
+
+    def watch_workers(self):
+        while not self.stopping.is_set():
+            sentinels = {process.sentinel: i for i, process in self.processes.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=1):
+                if self.stopping.is_set():
+                    return
+                process = self.processes[sentinels[sentinel]]
+                process.join()
+                logging.error(
+                    'Worker pid=%s exited with code %s, restarting',
+                    process.pid,
+                    process.exitcode,
+                )
+                if self.stopping.wait(consts.WORKER_RESTART_DELAY):
+                    return
+                self.start_worker(sentinels[sentinel])
+
+    def pump_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            kind, *payload = event
+            if kind == 'message':
+                control.hub.publish(*payload)
+            elif kind == 'counters':
+                backpressure.counters.update_remote(*payload)
+
+    def stop(self):
+        self.stopping.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
+        self.events.put(None)
+
+    def run(self):
+        with control.ControlServer(consts.CONTROL_SOCKET) as control_server:
+
+            def signal_handler(sig, frame):
+                logging.info('Supervisor gracefully shutting down')
+                control_server.shutdown()
+                self.stop()
+                logging.info('Server shut down')
+
+            for i in range(self.workers):
+                self.start_worker(i)
+            threads = [
+                threading.Thread(target=control_server.serve_forever),
+                threading.Thread(target=self.watch_workers),
+                threading.Thread(target=self.pump_events),
+            ]
+            signal.signal(signal.SIGTERM, signal_handler)
+            logging.info(
+                'Start supervisor, pid=%s, workers=%s', os.getpid(), self.workers
+            )
+            for thread in threads:
+                thread.start()
+
+            signal.pause()
+            for thread in threads:
+                thread.join()
+
+
+def check_port_free(host, port):
+    # Fail here instead of letting workers crash and restart forever
+    with Server((host, port), MyTCPHandler):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--workers', type=int, default=1)
+
+    args = parser.parse_args()
+    if not 1 <= args.workers <= consts.MAX_WORKERS:
+        parser.error(f'--workers must be between 1 and {consts.MAX_WORKERS}')
+    host, port = args.host, args.port
+
+    if control.is_running():
+        logging.error('Another daemon is running already')
+        sys.exit(1)
+    if os.path.exists(consts.CONTROL_SOCKET):
+        # Left over from a daemon that did not shut down cleanly
+        os.unlink(consts.CONTROL_SOCKET)
+
+    if args.workers > 1:
+        check_port_free(host, port)
+        Supervisor(host, port, args.workers).run()
+    else:
+        run_single(host, port)
+
+    os.unlink(consts.CONTROL_SOCKET)
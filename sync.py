@@ -0,0 +1,269 @@
+import hashlib
+import logging
+import queue
+import time
+
+import consts
+import db
+import health
+import models
+import transport
+
+
+SYNC_TYPES = {
+    models.MessageType.SYNC_DIGEST.value,
+    models.MessageType.SYNC_IDS.value,
+    models.MessageType.SYNC_REQUEST.value,
+    models.MessageType.SYNC_ENVELOPES.value,
+}
+
+
+def envelope_key(msg_id, msg_type, sender):
+    return f'{msg_type}:{sender}:{msg_id}'
+
+
+def recent_buckets():
+    '''
+    Keys of stored envelopes in the sync window, grouped in time buckets
+    by the timestamp set by their original sender.
+    '''
+    now = time.time()
+    # Skip the oldest bucket: it is being pruned, peers would disagree on it
+    first = int((now - consts.SYNC_WINDOW) // consts.SYNC_BUCKET) + 1
+    buckets = {}
+    for msg_id, msg_type, sender, ts in db.DB.fetch_envelope_keys_since(
+        first * consts.SYNC_BUCKET
+    ):
+        bucket = str(int(ts // consts.SYNC_BUCKET))
+        buckets.setdefault(bucket, set()).add(envelope_key(msg_id, msg_type, sender))
+    return buckets
+
+
+def key_hash(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def paths_of(key, ts):
+    '''Sub-bucket paths of all depths an envelope belongs to.'''
+    bucket, digest = int(ts // consts.SYNC_BUCKET), key_hash(key)
+    return [f'{bucket}:{digest[:depth]}' for depth in range(consts.SYNC_MAX_DEPTH + 1)]
+
+
+def keys_under(buckets: dict, path):
+    '''
+    Keys of sub-bucket `path`: time bucket and prefix of key hashes,
+    joined with a colon. Empty prefix stands for the whole time bucket.
+    '''
+    bucket, prefix = path.split(':')
+    return {key for key in buckets.get(bucket, ()) if key_hash(key).startswith(prefix)}
+
+
+def children(buckets: dict, parents=None):
+    '''
+    Non-empty sub-buckets of `parents` one hex digit deeper, with their
+    keys. Whole time buckets if no parents are given.
+    '''
+    if parents is None:
+        return {f'{bucket}:': keys for bucket, keys in buckets.items()}
+    result = {}
+    for parent in parents:
+        depth = len(parent.split(':')[1])
+        for key in keys_under(buckets, parent):
+            result.setdefault(parent + key_hash(key)[depth], set()).add(key)
+    return result
+
+
+def digest(groups: dict):
+    return {
+        path: hashlib.sha256('\n'.join(sorted(keys)).encode('utf-8')).hexdigest()[:16]
+        for path, keys in groups.items()
+    }
+
+
+class Syncer:
+    '''
+    Anti-entropy between neighbours, so messages flooded while a node was
+    offline reach it without being resent by their senders.
+
+    1. A sends B a digest: one short hash per time bucket.
+    2. B answers with its keys for the buckets whose hashes differ. Large
+       buckets are split by key hash instead, and B sends A a digest of
+       the sub-buckets. They recurse this way into differing sub-buckets
+       only, so ids of matching keys mostly stay home.
+    3. A sends B the envelopes B lacks and requests those it lacks itself.
+    4. B sends the requested envelopes.
+
+    Envelopes are sent as is, batched in one SYNC_ENVELOPES message, and
+    each goes through the usual dispatch on the receiving side. So only
+    the difference travels over the network, in one connection instead of
+    one per envelope that rate limits would drop. Only envelopes of the
+    sub-buckets a node sent ids for, or of keys it requested, are taken.
+    '''
+
+    def __init__(self):
+        self.transmitter = transport.Transmitter()
+        self.pending = queue.Queue()
+        self.pruned_at = None
+
+    def request_sync(self, peer_id):
+        self.pending.put(peer_id)
+
+    def run(self, stopped, periodic=True):
+        '''
+        Sync with peers that came back online, and with everybody every
+        SYNC_INTERVAL seconds if `periodic`. Returns once `stopped` is set.
+        '''
+        synced_at = None
+        while not stopped.is_set():
+            try:
+                self.prune()
+                if periodic and (
+                    synced_at is None or time.monotonic() - synced_at >= consts.SYNC_INTERVAL
+                ):
+                    # Failed round waits for the next one, not retried every second
+                    synced_at = time.monotonic()
+                    self.sync_all()
+                try:
+                    peer_id = self.pending.get(timeout=1)
+                except queue.Empty:
+                    continue
+                peer = db.DB.fetch_peer_by_id(peer_id)
+                if peer:
+                    self.sync(peer)
+            except Exception:  # noqa
+                logging.exception('Sync failed')
+
+    def prune(self):
+        # Here rather than in dispatchers, so an idle daemon trims too
+        now = time.monotonic()
+        if self.pruned_at is not None and now - self.pruned_at < consts.SEEN_PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        db.DB.delete_envelopes_before(time.time() - consts.SYNC_WINDOW - consts.SYNC_BUCKET)
+        db.DB.delete_sync_expected_before(time.time())
+
+    def sync_all(self):
+        # Peers with open breaker are synced through on_recovered once back
+        for peer in db.DB.fetch_all_peers():
+            if health.tracker.is_closed(peer.peer_id):
+                self.sync(peer)
+
+    def sync(self, peer: models.Peer):
+        logging.info('Sync with %s', peer.name)
+        self.send(
+            peer,
+            models.MessageType.SYNC_DIGEST,
+            {'digest': digest(children(recent_buckets()))},
+        )
+
+    def send(
+        self, peer: models.Peer, msg_type: models.MessageType, payload: dict, **kwargs
+    ):
+        msg = self.transmitter.default_msg_dict(peer)
+        msg['type'] = msg_type.value
+        msg.update(payload)
+        try:
+            rtt = self.transmitter.send(peer, msg, **kwargs)
+        except OSError:
+            logging.info('Cannot reach %s on %s for sync', peer.name, peer.ip)
+            health.tracker.record_failure(peer.peer_id)
+            return
+        health.tracker.record_success(peer.peer_id, rtt)
+
+    def send_envelopes(self, peer: models.Peer, keys):
+        envelopes = []
+        for key in sorted(keys)[: consts.SYNC_MAX_ENVELOPES]:
+            msg_type, sender, msg_id = key.split(':', 2)
+            envelope = db.DB.fetch_envelope(msg_id, msg_type, sender)
+            if envelope is not None:
+                envelopes.append(envelope)
+        if envelopes:
+            self.send(
+                peer,
+                models.MessageType.SYNC_ENVELOPES,
+                {'envelopes': envelopes},
+                send_timeout=consts.SYNC_SEND_TIMEOUT,
+            )
+
+    def expect(self, peer: models.Peer, scopes):
+        db.DB.add_sync_expected(peer.peer_id, scopes, time.time() + consts.SYNC_EXPECT_TTL)
+
+    def accept(self, peer: models.Peer, envelopes):
+        '''
+        Envelopes out of `envelopes` this node asked `peer` for.
+        '''
+        scopes = db.DB.fetch_sync_expected(peer.peer_id, time.time())
+        accepted = []
+        for envelope in envelopes[: consts.SYNC_MAX_ENVELOPES]:
+            try:
+                key = envelope_key(envelope['id'], envelope['type'], envelope['from'])
+                paths = paths_of(key, float(envelope['ts']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if key in scopes or any(path in scopes for path in paths):
+                accepted.append(envelope)
+        return accepted
+
+    def handle(self, data, peer: models.Peer):
+        msg_type = data['type']
+        if msg_type == models.MessageType.SYNC_DIGEST.value:
+            self.handle_digest(data, peer)
+        elif msg_type == models.MessageType.SYNC_IDS.value:
+            self.handle_ids(data, peer)
+        elif msg_type == models.MessageType.SYNC_REQUEST.value:
+            self.send_envelopes(peer, data['ids'])
+
+    def handle_digest(self, data, peer):
+        buckets = recent_buckets()
+        groups = children(buckets, data.get('parents'))
+        mine, theirs = digest(groups), data['digest']
+        ids, split = {}, []
+        for path in set(mine) | set(theirs):
+            if mine.get(path) == theirs.get(path):
+                continue
+            keys = groups.get(path, set())
+            depth = len(path.split(':')[1])
+            # Splitting pays off only if both sides have many keys there
+            if (
+                path in theirs
+                and len(keys) > consts.SYNC_LEAF_SIZE
+                and depth < consts.SYNC_MAX_DEPTH
+            ):
+                split.append(path)
+            else:
+                ids[path] = sorted(keys)
+        if not ids and not split:
+            logging.info('In sync with %s', peer.name)
+            return
+        if split:
+            self.send(
+                peer,
+                models.MessageType.SYNC_DIGEST,
+                {'parents': split, 'digest': digest(children(buckets, split))},
+            )
+        if ids:
+            # Peer answers with envelopes of these sub-buckets we lack
+            self.expect(peer, ids)
+            self.send(peer, models.MessageType.SYNC_IDS, {'ids': ids})
+
+    def handle_ids(self, data, peer):
+        buckets = recent_buckets()
+        missing_there, missing_here = set(), set()
+        for path, keys in data['ids'].items():
+            mine, theirs = keys_under(buckets, path), set(keys)
+            missing_there |= mine - theirs
+            missing_here |= theirs - mine
+        logging.info(
+            'Sync with %s: %s envelopes to send, %s to request',
+            peer.name,
+            len(missing_there),
+            len(missing_here),
+        )
+        self.send_envelopes(peer, missing_there)
+        if missing_here:
+            ids = sorted(missing_here)[: consts.SYNC_MAX_ENVELOPES]
+            self.expect(peer, ids)
+            self.send(peer, models.MessageType.SYNC_REQUEST, {'ids': ids})
+
+
+syncer = Syncer()
@@ -1,18 +1,21 @@
 import json
 import logging
 import socket
+import time
 import uuid
 
+import chain
 import consts
 import db
 import encryption
+import health
 import models
 
 
 class Transport:
     def __init__(self, sck: socket.socket, peer: models.Peer):
         self.sck = sck
-        self.encryptor = encryption.Encryptor(peer.key)
+        self.encryptor = encryption.get_encryptor(peer.key)
         self.ip = peer.ip
 
     def send(self, message: dict):
@@ -20,15 +23,28 @@ class Transport:
         encrypted = self.encryptor.encrypt(bytes_msg)
         self.sck.sendall(encrypted)
 
-    def receive_all(self):
-        data = b''
+    def receive_all(self, max_size=None, timeout=None):
+        '''
+        Read message until the peer closes the connection. Raises
+        socket.timeout if it takes longer than `timeout` seconds in total,
+        ValueError if it is larger than `max_size` bytes.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        data = bytearray()
         while True:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('message did not arrive in time')
+                self.sck.settimeout(remaining)
             received = self.sck.recv(consts.SCK_BUFF_SIZE)
             if len(received) < 1:
                 break
             data += received
+            if max_size is not None and len(data) > max_size:
+                raise ValueError(f'message is larger than {max_size} bytes')
 
-        bytes_msg = self.encryptor.decrypt(data)
+        bytes_msg = self.encryptor.decrypt(bytes(data))
         return Transport._load_from_bytes(bytes_msg)
 
     def connect(self):
@@ -44,9 +60,9 @@ class Transport:
         return json.loads(str(message, encoding='utf-8'))
 
     @staticmethod
-    def create_socket():
+    def create_socket(timeout=consts.SCK_TIMEOUT):
         sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sck.settimeout(consts.SCK_TIMEOUT)
+        sck.settimeout(timeout)
         return sck
 
 
@@ -58,41 +74,142 @@ class Transmitter:
 
         if msg.get('body'):
             msg['body'] = (
-                encryption.Encryptor(target.key)
+                encryption.get_encryptor(target.key)
                 .encrypt(msg['body'].encode('utf-8'))
                 .decode('utf-8')
             )
 
         return self.send_to_every_peer(msg)
 
+    def send_message(self, target: models.Peer, text: str):
+        msg = {
+            'id': uuid.uuid4().hex,
+            'type': models.MessageType.MESSAGE.value,
+            'body': text,
+        }
+        db.DB.insert_message(
+            msg['id'], db.get_peer_id(), text, received=False, seen=False, decrypted=True
+        )
+        db.DB.add_receipts([(msg['id'], target.peer_id)])
+        return self.transmit(target, msg)
+
+    def send_group_message(self, targets: list, text: str):
+        '''
+        Send one envelope to several peers: `to` lists every recipient and
+        `bodies` holds the text encrypted for each of them.
+        '''
+        msg = self.default_msg_dict(targets[0])
+        msg.update(
+            {
+                'type': models.MessageType.GROUP.value,
+                'to': [target.peer_id for target in targets],
+                'bodies': {
+                    target.peer_id: encryption.get_encryptor(target.key)
+                    .encrypt(text.encode('utf-8'))
+                    .decode('utf-8')
+                    for target in targets
+                },
+            }
+        )
+        db.DB.insert_message(
+            msg['id'], msg['from'], text, received=False, seen=False, decrypted=True
+        )
+        db.DB.add_receipts([(msg['id'], peer_id) for peer_id in msg['to']])
+        return self.send_to_every_peer(msg)
+
+    def send_messages(self, batch: list, pacer=None):
+        '''
+        Send (target, text) pairs, storing them in one transaction and
+        encrypting each recipient's messages with a single Fernet instance.
+        A `pacer` token bucket, if given, is waited on before every send.
+
+        Returns the number of peers reached for every pair, in order.
+        '''
+        my_peer_id = db.get_peer_id()
+        my_peers = db.DB.fetch_all_peers()
+
+        msgs = []
+        by_key = {}
+        for i, (target, text) in enumerate(batch):
+            msg = self.default_msg_dict(target, my_peer_id)
+            msg.update({'type': models.MessageType.MESSAGE.value, 'body': text})
+            msgs.append(msg)
+            by_key.setdefault(target.key, []).append(i)
+
+        db.DB.insert_messages(
+            [
+                {'msg_id': msg['id'], 'sender': my_peer_id, 'body': msg['body'], 'decrypted': True}
+                for msg in msgs
+            ]
+        )
+        db.DB.add_receipts([(msg['id'], msg['to']) for msg in msgs])
+
+        success = [0] * len(msgs)
+        for key, indexes in by_key.items():
+            encryptor = encryption.get_encryptor(key)
+            for i in indexes:
+                msg = msgs[i]
+                msg['body'] = encryptor.encrypt(msg['body'].encode('utf-8')).decode('utf-8')
+                if pacer is not None:
+                    pacer.wait()
+                success[i] = self.send_to_every_peer(msg, my_peers)
+        return success
+
     def retransmit(self, msg):
         return self.send_to_every_peer(self.update_chain(msg))
 
-    def send_to_every_peer(self, msg: dict):
-        my_peers = db.DB.fetch_all_peers()
+    def send_to_every_peer(self, msg: dict, my_peers=None):
+        if my_peers is None:
+            my_peers = db.DB.fetch_all_peers()
+        db.store_envelope(msg)
         success = 0
         for peer in my_peers:
+            if not health.tracker.allow(peer.peer_id):
+                logging.debug(f'Skip {peer.name}: circuit breaker is open')
+                continue
             try:
-                self.send(peer, msg)
-                success += 1
-            except (socket.timeout, ConnectionRefusedError):
+                rtt = self.send(peer, msg)
+            except OSError:
                 logging.info(f'Cannot reach {peer.name} on {peer.ip}')
+                health.tracker.record_failure(peer.peer_id)
+                continue
+            health.tracker.record_success(peer.peer_id, rtt)
+            success += 1
         return success
 
-    def send(self, peer: models.Peer, msg: dict):
-        transport = Transport(Transport.create_socket(), peer).connect()
-        transport.send(msg)
-
-    def default_msg_dict(self, target: models.Peer):
-        my_peer_id = db.get_peer_id()
+    def send(self, peer: models.Peer, msg: dict, send_timeout=None):
+        '''
+        Send message to peer. Returns time it took to connect.
+
+        Connect timeout adapts to peer RTT; `send_timeout` overrides it
+        once connected, for large messages.
+        '''
+        sck = Transport.create_socket(health.tracker.timeout(peer.peer_id))
+        with sck:
+            started = time.monotonic()
+            transport = Transport(sck, peer).connect()
+            rtt = time.monotonic() - started
+            if send_timeout is not None:
+                sck.settimeout(send_timeout)
+            transport.send(msg)
+        return rtt
+
+    def default_msg_dict(self, target: models.Peer, my_peer_id=None):
+        if my_peer_id is None:
+            my_peer_id = db.get_peer_id()
         return {
             'id': uuid.uuid4().hex,
             'from': my_peer_id,
             'to': target.peer_id,
-            'chain': [my_peer_id],
+            'chain': chain.Chain().add(my_peer_id).encode(),
+            'ttl': consts.MSG_TTL,
+            'ts': time.time(),
         }
 
     def update_chain(self, message_dict: dict):
         my_peer_id = db.get_peer_id()
-        message_dict['chain'].append(my_peer_id)
+        message_dict['chain'] = (
+            chain.Chain.decode(message_dict['chain']).add(my_peer_id).encode()
+        )
+        message_dict['ttl'] -= 1
         return message_dict